@@ -2,80 +2,319 @@
 """
 Vision Helper for Burner Phone Skill
 Sends images to Senter Server for visual analysis.
+
+Run with --server to keep one connection open and analyze newline-delimited
+{"path": ..., "prompt": ...} JSON requests read from stdin, or with
+--daemon [socket_path] to answer the same requests on a Unix domain socket
+(default $XDG_RUNTIME_DIR/goclaw-vision.sock).
 """
 
-import json, os, sys, base64, urllib.request
+import json, os, sys, mmap, uuid, zlib, socket, tempfile, http.client, urllib.parse, urllib.request
+from binascii import b2a_base64
+
+# orjson parses responses and daemon requests faster than the stdlib
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# ijson lets us pick the reply out of the response without loading all of it
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Configuration via environment
 SENTER_URL = os.getenv("SENTER_URL", "http://localhost:8081")
 VISION_MODEL = os.getenv("VISION_MODEL", "qwen2.5-omni:3b")
+# Set SENTER_BINARY=1 to POST raw image bytes to /v1/vision/binary instead of base64 JSON
+SENTER_BINARY = os.getenv("SENTER_BINARY") == "1"
+# Set SENTER_GZIP=1 to gzip the JSON request body (the server must accept Content-Encoding: gzip)
+SENTER_GZIP = os.getenv("SENTER_GZIP") == "1"
+
+DEFAULT_PROMPT = "Analyze this screen."
+
+# Standard OpenAI-Format Request, serialized up to the base64 image (which needs no
+# JSON escaping) so only the prompt is encoded per call
+CHAT_PAYLOAD_HEAD = (
+    '{"model":' + json.dumps(VISION_MODEL) + ',"messages":[{"role":"user","content":['
+    '{"type":"text","text":%s},'
+    '{"type":"image_url","image_url":{"url":"data:image/png;base64,'
+)
+CHAT_PAYLOAD_TAIL = b'"}}]}],"max_tokens":512,"temperature":0.1}'
+
+# Slice size for streaming base64; a multiple of 3 so chunks encode without padding
+CHUNK = 3 * 256 * 1024
+
+class ImageReadError(Exception):
+    pass
 
 def log(msg):
     print(f"DEBUG: {msg}", file=sys.stderr, flush=True)
 
+def encode_image(path):
+    """Base64-encode a memory-mapped file slice by slice into a preallocated buffer."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        out = bytearray(4 * ((size + 2) // 3))
+        if size == 0:
+            return out
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            pos = 0
+            for offset in range(0, size, CHUNK):
+                encoded = b2a_base64(view[offset:offset + CHUNK], newline=False)
+                out[pos:pos + len(encoded)] = encoded
+                pos += len(encoded)
+    return out
+
+def build_multipart(path, user_prompt):
+    """Assemble a multipart/form-data body carrying the model, prompt and raw image bytes."""
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for name, value in (("model", VISION_MODEL), ("prompt", user_prompt)):
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                 f'{value}\r\n').encode()
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; '
+             f'filename="{os.path.basename(path)}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    with open(path, "rb") as f:
+        body += f.read()
+    body += f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def senter_proxy():
+    """Return the proxy URL for SENTER_URL from http_proxy/https_proxy/no_proxy, or None."""
+    url = urllib.parse.urlsplit(SENTER_URL)
+    proxy = urllib.request.getproxies().get(url.scheme)
+    if not proxy or urllib.request.proxy_bypass(url.hostname or ""):
+        return None
+    return urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+
+SENTER_PROXY = senter_proxy()
+
+def proxy_headers():
+    """Proxy-Authorization header for credentials embedded in the proxy URL, as urllib sends."""
+    if SENTER_PROXY is None or SENTER_PROXY.username is None:
+        return {}
+    creds = f"{urllib.parse.unquote(SENTER_PROXY.username)}:{urllib.parse.unquote(SENTER_PROXY.password or '')}"
+    return {"Proxy-Authorization": "Basic " + b2a_base64(creds.encode(), newline=False).decode()}
+
+def open_connection():
+    """Open a keep-alive connection to the Senter server, through the environment's proxy if set."""
+    url = urllib.parse.urlsplit(SENTER_URL)
+    if SENTER_PROXY is None:
+        if url.scheme == "https":
+            return http.client.HTTPSConnection(url.netloc, timeout=300)
+        return http.client.HTTPConnection(url.netloc, timeout=300)
+
+    proxy_host, proxy_port = SENTER_PROXY.hostname, SENTER_PROXY.port
+    if url.scheme == "https":
+        # HTTPS goes through a CONNECT tunnel; plain HTTP sends absolute URLs to the proxy (see post)
+        conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=300)
+        conn.set_tunnel(url.hostname, url.port, headers=proxy_headers())
+        return conn
+    return http.client.HTTPConnection(proxy_host, proxy_port, timeout=300)
+
+def gzip_parts(parts):
+    """Gzip the concatenation of parts; level 1 since the upload is network-bound, not CPU-bound."""
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return [compressor.compress(p) for p in parts] + [compressor.flush()]
+
+def post(conn, endpoint, parts, content_type, content_encoding=None):
+    """POST the concatenation of parts over a reused connection and return the unread response."""
+    url = urllib.parse.urlsplit(SENTER_URL).path.rstrip("/") + endpoint
+    # An explicit length lets http.client send the parts back to back without joining them
+    headers = {"Content-Type": content_type, "Content-Length": str(sum(len(p) for p in parts))}
+    if SENTER_PROXY is not None and not SENTER_URL.startswith("https"):
+        # A forward proxy needs the absolute URL in the request line
+        url = SENTER_URL.rstrip("/") + endpoint
+        headers.update(proxy_headers())
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    try:
+        try:
+            conn.request("POST", url, body=parts, headers=headers)
+            res = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server closed the idle keep-alive connection; reconnect once
+            conn.close()
+            conn.request("POST", url, body=parts, headers=headers)
+            res = conn.getresponse()
+    except Exception:
+        # Reset the connection so it does not stay stuck mid-request for the next call
+        conn.close()
+        raise
+    return res
+
+def post_binary(conn, body, content_type):
+    """Send a multipart body to the binary endpoint; returns None if the server lacks it."""
+    res = post(conn, "/v1/vision/binary", (body,), content_type)
+    if res.status == 404:
+        res.read()
+        log("Binary endpoint not found, falling back to base64")
+        return None
+    if res.status >= 400:
+        raise RuntimeError(f"HTTP Error {res.status}: {res.read().decode()}")
+    return res
+
+def post_chat(conn, img_b64, user_prompt):
+    """Send base64 image bytes through the OpenAI-compatible chat endpoint."""
+    head = (CHAT_PAYLOAD_HEAD % json.dumps(user_prompt)).encode()
+    parts = (head, img_b64, CHAT_PAYLOAD_TAIL)
+    if SENTER_GZIP:
+        res = post(conn, "/v1/chat/completions", gzip_parts(parts), "application/json", "gzip")
+    else:
+        res = post(conn, "/v1/chat/completions", parts, "application/json")
+    if res.status >= 400:
+        raise RuntimeError(f"HTTP Error {res.status}: {res.read().decode()}")
+    return res
+
+class RecordingReader:
+    """File-like wrapper keeping the bytes read so the raw body can be reported on errors."""
+
+    def __init__(self, res):
+        self.res = res
+        self.data = bytearray()
+
+    def read(self, n=-1):
+        chunk = self.res.read(n)
+        self.data += chunk
+        return chunk
+
+def extract_content(res):
+    """Return choices[0].message.content from a completion response."""
+    if ijson is not None:
+        reader = RecordingReader(res)
+        try:
+            for prefix, event, value in ijson.parse(reader):
+                # The first match belongs to choices[0]; content may be null
+                if prefix == "choices.item.message.content" and event in ("string", "null"):
+                    return value
+        except ijson.JSONError:
+            reader.read()
+            raise RuntimeError(f"Invalid JSON: {reader.data.decode(errors='replace')}")
+        finally:
+            # Drain the rest so the keep-alive connection can be reused
+            reader.read()
+        raise RuntimeError(f"API Error: {reader.data.decode(errors='replace')}")
+
+    raw_response = res.read().decode()
+    try:
+        resp_json = _loads(raw_response)
+    except json.JSONDecodeError:
+        raise RuntimeError(f"Invalid JSON: {raw_response}")
+    if "choices" not in resp_json:
+        raise RuntimeError(f"API Error: {raw_response}")
+    return resp_json["choices"][0]["message"]["content"]
+
+def analyze(path, user_prompt, conn):
+    """Run one image through the vision model and return the model's reply."""
+    # Read image as multipart body or Base64
+    try:
+        if SENTER_BINARY:
+            body, content_type = build_multipart(path, user_prompt)
+        else:
+            img_b64 = encode_image(path)
+    except OSError as e:
+        raise ImageReadError(e) from e
+
+    res = None
+    if SENTER_BINARY:
+        res = post_binary(conn, body, content_type)
+        if res is None:
+            img_b64 = encode_image(path)
+    if res is None:
+        res = post_chat(conn, img_b64, user_prompt)
+    return extract_content(res)
+
+def handle_requests(rfile, wfile, conn):
+    """Answer newline-delimited JSON requests from rfile with one JSON line each on wfile."""
+    for line in rfile:
+        if not line.strip():
+            continue
+        try:
+            task = _loads(line)
+            result = {"content": analyze(task["path"], task.get("prompt") or DEFAULT_PROMPT, conn)}
+        except Exception as e:
+            log(f"Vision Error: {e}")
+            result = {"error": str(e)}
+            # A failure may leave a response unread; start the next request on a fresh connection
+            conn.close()
+        wfile.write(json.dumps(result, ensure_ascii=False) + "\n")
+        wfile.flush()
+
+def serve():
+    """Answer requests from stdin over one persistent connection."""
+    conn = open_connection()
+    try:
+        handle_requests(sys.stdin, sys.stdout, conn)
+    finally:
+        conn.close()
+
+def serve_socket(sock_path):
+    """Answer requests on a Unix domain socket, one client at a time, until interrupted."""
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owning user may connect
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(sock_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    log(f"Listening on {sock_path}")
+
+    conn = open_connection()
+    try:
+        while True:
+            client, _ = server.accept()
+            with client, client.makefile("r", encoding="utf-8") as rfile, \
+                    client.makefile("w", encoding="utf-8") as wfile:
+                try:
+                    handle_requests(rfile, wfile, conn)
+                except OSError as e:
+                    log(f"Client Error: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+        server.close()
+        os.unlink(sock_path)
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--server":
+        serve()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        runtime_dir = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+        serve_socket(sys.argv[2] if len(sys.argv) > 2 else os.path.join(runtime_dir, "goclaw-vision.sock"))
+        return
+
     if len(sys.argv) < 2:
-        print("Usage: vision_helper.py <path_to_image> [prompt]")
+        print("Usage: vision_helper.py <path_to_image> [prompt] | --server | --daemon [socket_path]")
         sys.exit(1)
 
     path = sys.argv[1]
-    user_prompt = sys.argv[2] if len(sys.argv) > 2 else "Analyze this screen."
+    user_prompt = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PROMPT
 
     if not os.path.exists(path):
         log(f"Error: File not found: {path}")
         sys.exit(1)
 
-    # Read image as Base64
+    log("Calling vision model...")
+    conn = open_connection()
     try:
-        with open(path, "rb") as f:
-            img_b64 = base64.b64encode(f.read()).decode()
-    except Exception as e:
+        print(analyze(path, user_prompt, conn))
+    except ImageReadError as e:
         log(f"Image Read Error: {e}")
         sys.exit(1)
-
-    # Standard OpenAI-Format Request
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": user_prompt},
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{img_b64}"}
-                }
-            ]
-        }
-    ]
-
-    data = {
-        "model": VISION_MODEL,
-        "messages": messages,
-        "max_tokens": 512,
-        "temperature": 0.1
-    }
-
-    log("Calling vision model...")
-    try:
-        req = urllib.request.Request(
-            f"{SENTER_URL}/v1/chat/completions",
-            data=json.dumps(data).encode(), 
-            headers={"Content-Type": "application/json"}
-        )
-        with urllib.request.urlopen(req, timeout=300) as res:
-            raw_response = res.read().decode()
-            try:
-                resp_json = json.loads(raw_response)
-                if "choices" in resp_json:
-                    content = resp_json["choices"][0]["message"]["content"]
-                    print(content)
-                else:
-                    log(f"API Error: {raw_response}")
-            except json.JSONDecodeError:
-                log(f"Invalid JSON: {raw_response}")
-            
     except Exception as e:
         log(f"Vision Error: {e}")
         print(f"[ERROR: Vision analysis failed. Details: {e}]")
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     main()
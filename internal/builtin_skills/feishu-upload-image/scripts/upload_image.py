@@ -3,22 +3,74 @@
 Feishu/Lark Image Upload Script
 
 Uploads images to Feishu/Lark and returns the image_key.
+
+Run with --daemon to keep the session and access token warm and serve
+newline-delimited JSON commands on a Unix domain socket, e.g.
+{"cmd": "upload_file", "path": "image.png", "type": "message"}.
 """
 
-import argparse
-import base64
 import io
 import json
+import mmap
 import os
+import socket
 import sys
+import tempfile
+import time
+import uuid
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Optional
 
-try:
-    import requests
-except ImportError:
-    print("Error: requests module is required. Install with: pip3 install requests")
-    sys.exit(1)
+
+class _MultipartBody:
+    """multipart/form-data upload body streamed from a replayable reader of known size
+
+    Exposes __len__ so requests sends a Content-Length instead of chunking,
+    and yields the image without copying it into an assembled body. The reader
+    must be an mmap or seekable so a retried request can replay it.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, reader, size: int, image_type: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._reader = reader
+        self._size = size
+        # Remember where the image starts so a retried request can replay it
+        self._start = None if isinstance(reader, mmap.mmap) else reader.tell()
+        self._header = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="image"; filename="image"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self._trailer = (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="image_type"\r\n\r\n'
+            f'{image_type}\r\n--{boundary}--\r\n'
+        ).encode()
+
+    def __len__(self) -> int:
+        return len(self._header) + self._size + len(self._trailer)
+
+    def __iter__(self):
+        yield self._header
+        if isinstance(self._reader, mmap.mmap):
+            # Slices of the mapping go to the socket without a userspace copy
+            view = memoryview(self._reader)
+            for offset in range(0, self._size, self.CHUNK_SIZE):
+                yield view[offset:offset + self.CHUNK_SIZE]
+        else:
+            self._reader.seek(self._start)
+            remaining = self._size
+            while remaining > 0:
+                chunk = self._reader.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ValueError("Image data ended before its declared size")
+                remaining -= len(chunk)
+                yield chunk
+        yield self._trailer
 
 
 class FeishuImageUploader:
@@ -26,15 +78,51 @@ class FeishuImageUploader:
 
     API_BASE_URL = "https://open.feishu.cn"
     UPLOAD_ENDPOINT = "/open-apis/im/v1/images"
+    MAX_IMAGE_SIZE = 10 * 1024 * 1024
+    TOKEN_CACHE_PATH = Path.home() / ".goclaw" / "cache" / "feishu_token.json"
+    # Error codes for a missing, invalid or expired access token
+    INVALID_TOKEN_CODES = frozenset([99991661, 99991663, 99991668, 99991677])
 
     def __init__(self, app_id: str, app_secret: str):
         self.app_id = app_id
         self.app_secret = app_secret
         self._access_token: Optional[str] = None
+        self._token_expires_at = 0.0
+
+        # Imported here so --help and credential errors skip loading requests
+        try:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+        except ImportError:
+            print("Error: requests module is required. Install with: pip3 install requests")
+            sys.exit(1)
+
+        # Share one connection pool so auth and upload reuse the same TLS connection
+        self._session = requests.Session()
+        # Retry throttling and transient 5xx, honouring Retry-After. POST is included
+        # because upload bodies are always replayable (see upload_from_reader). Once
+        # retries run out the last response is returned so Feishu's msg is reported
+        retry = Retry(
+            total=4,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry)
+        # http:// as well, since upload_from_url may download from plain HTTP hosts
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
     def get_access_token(self) -> str:
         """Get app_access_token"""
-        if self._access_token:
+        # Leave a minute of headroom so the token does not expire mid-upload
+        if self._access_token and time.time() < self._token_expires_at - 60:
+            return self._access_token
+
+        if self._load_cached_token():
             return self._access_token
 
         url = f"{self.API_BASE_URL}/open-apis/auth/v3/app_access_token/internal"
@@ -43,54 +131,150 @@ class FeishuImageUploader:
             "app_secret": self.app_secret
         }
 
-        response = requests.post(url, json=payload)
-        data = response.json()
+        response = self._session.post(url, json=payload)
+        data = self._response_json(response)
 
         if data.get("code") != 0:
             raise RuntimeError(f"Failed to get access token: {data.get('msg')}")
 
         self._access_token = data.get("app_access_token")
+        self._token_expires_at = time.time() + data.get("expire", 0)
+        self._save_cached_token()
         return self._access_token
 
+    @staticmethod
+    def _response_json(response) -> dict:
+        """Decode a Feishu response, reporting the HTTP status when the body is not JSON"""
+        try:
+            return response.json()
+        except ValueError:
+            return {"code": -1, "msg": f"HTTP {response.status_code} {response.reason}"}
+
+    def _load_cached_token(self) -> bool:
+        """Adopt the token cached by a previous run if it is still valid"""
+        try:
+            with open(self.TOKEN_CACHE_PATH) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if cached.get("app_id") != self.app_id or not cached.get("token"):
+            return False
+        if time.time() >= cached.get("expires_at", 0) - 60:
+            return False
+
+        self._access_token = cached["token"]
+        self._token_expires_at = cached["expires_at"]
+        return True
+
+    def _invalidate_token(self) -> None:
+        """Forget a token the API rejected, in memory and on disk"""
+        self._access_token = None
+        self._token_expires_at = 0.0
+        try:
+            os.remove(self.TOKEN_CACHE_PATH)
+        except OSError:
+            pass
+
+    def _save_cached_token(self) -> None:
+        """Persist the token so later runs can skip the auth round trip"""
+        cache_dir = self.TOKEN_CACHE_PATH.parent
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # mkstemp creates the file with 0600 permissions
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".feishu_token.")
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "app_id": self.app_id,
+                    "token": self._access_token,
+                    "expires_at": self._token_expires_at
+                }, f)
+            os.replace(tmp_path, self.TOKEN_CACHE_PATH)
+        except OSError:
+            # Caching is best effort; the token is still usable for this run
+            pass
+
     def upload_from_file(self, file_path: str, image_type: str = "message") -> str:
         """Upload image from local file"""
-        with open(file_path, "rb") as f:
-            return self.upload_from_reader(f, image_type)
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Reject oversized files from stat alone, before opening them or fetching a token
+        size = os.path.getsize(file_path)
+        if size > self.MAX_IMAGE_SIZE:
+            raise ValueError("Image size exceeds 10MB limit")
+        if size == 0:
+            raise ValueError(f"Image file is empty: {file_path}")
+
+        # Overlap the token round trip with opening and mapping the file
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            token = pool.submit(self.get_access_token)
+            with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                token.result()
+                return self.upload_from_reader(mm, size, image_type)
 
     def upload_from_url(self, url: str, image_type: str = "message") -> str:
         """Upload image from URL"""
-        response = requests.get(url)
-        response.raise_for_status()
-        return self.upload_from_reader(io.BytesIO(response.content), image_type)
+        with self._session.get(url, stream=True) as response:
+            response.raise_for_status()
+            # Reject oversized images before downloading them; an encoded body's
+            # Content-Length counts compressed bytes, so only trust it for identity
+            content_length = response.headers.get("Content-Length")
+            content_encoding = response.headers.get("Content-Encoding", "identity").lower()
+            if content_length is not None and content_encoding == "identity" \
+                    and int(content_length) > self.MAX_IMAGE_SIZE:
+                raise ValueError("Image size exceeds 10MB limit")
+
+            # Buffer the decoded body (at most 10MB) so the upload can be replayed on retry
+            content = response.content
+            return self.upload_from_reader(io.BytesIO(content), len(content), image_type)
 
     def upload_from_base64(self, data: str, image_type: str = "message") -> str:
         """Upload image from base64 string"""
+        # Reject oversized payloads from the encoded length before allocating the decoded bytes.
+        # Only alphabet characters count: encoders such as GNU base64 wrap lines at 76 columns
+        encoded_len = len(data) - sum(data.count(c) for c in " \t\r\n")
+        padding = len(data.rstrip()) - len(data.rstrip().rstrip("="))
+        if encoded_len * 3 // 4 - padding > self.MAX_IMAGE_SIZE:
+            raise ValueError("Image size exceeds 10MB limit")
+
+        import base64
+
         decoded = base64.b64decode(data)
-        return self.upload_from_reader(io.BytesIO(decoded), image_type)
-
-    def upload_from_reader(self, reader: io.IOBase, image_type: str = "message") -> str:
-        """Upload image from any reader (file-like object)"""
-        # Check file size (10MB limit)
-        reader.seek(0, os.SEEK_END)
-        size = reader.tell()
-        if size > 10 * 1024 * 1024:
+        return self.upload_from_reader(io.BytesIO(decoded), len(decoded), image_type)
+
+    def upload_from_reader(self, reader: io.IOBase, size: int, image_type: str = "message") -> str:
+        """Upload image from any reader (file-like object) of the given size in bytes"""
+        # Check file size (10MB limit); the reader need not be seekable
+        if size > self.MAX_IMAGE_SIZE:
             raise ValueError("Image size exceeds 10MB limit")
-        reader.seek(0)
+
+        if not isinstance(reader, mmap.mmap) and not reader.seekable():
+            # Buffer streams so a retried upload can send the image again
+            content = bytearray()
+            while len(content) < size:
+                chunk = reader.read(size - len(content))
+                if not chunk:
+                    raise ValueError("Image data ended before its declared size")
+                content += chunk
+            reader = io.BytesIO(content)
 
         # Prepare multipart/form-data request
         url = f"{self.API_BASE_URL}{self.UPLOAD_ENDPOINT}"
-        headers = {
-            "Authorization": f"Bearer {self.get_access_token()}"
-        }
-
-        # Reset reader position before reading
-        files = {
-            "image": reader,
-            "image_type": (None, image_type)
-        }
-
-        response = requests.post(url, headers=headers, files=files)
-        data = response.json()
+        body = _MultipartBody(reader, size, image_type)
+
+        for attempt in range(2):
+            headers = {
+                "Authorization": f"Bearer {self.get_access_token()}",
+                "Content-Type": body.content_type
+            }
+            response = self._session.post(url, headers=headers, data=body)
+            data = self._response_json(response)
+
+            # A cached token can be revoked before it expires; fetch a fresh one and retry once
+            if attempt == 0 and data.get("code") in self.INVALID_TOKEN_CODES:
+                self._invalidate_token()
+                continue
+            break
 
         if data.get("code") != 0:
             raise RuntimeError(f"Upload failed: {data.get('msg')}")
@@ -133,7 +317,71 @@ def load_config() -> tuple[str, str]:
     return app_id, app_secret
 
 
-def main():
+def default_socket_path() -> str:
+    """Socket path used by --daemon when none is given"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, "goclaw-feishu.sock")
+
+
+def handle_command(uploader: FeishuImageUploader, line: str) -> dict:
+    """Run one daemon command and return its JSON response"""
+    try:
+        command = json.loads(line)
+        cmd = command.get("cmd")
+        image_type = command.get("type", "message")
+        if cmd == "upload_file":
+            image_key = uploader.upload_from_file(command["path"], image_type)
+        elif cmd == "upload_url":
+            image_key = uploader.upload_from_url(command["url"], image_type)
+        elif cmd == "upload_base64":
+            image_key = uploader.upload_from_base64(command["data"], image_type)
+        else:
+            raise ValueError(f"Unknown command: {cmd}")
+    except Exception as e:
+        return {"code": -1, "msg": str(e)}
+
+    return {"code": 0, "data": {"image_key": image_key}}
+
+
+def serve_socket(uploader: FeishuImageUploader, sock_path: str) -> None:
+    """Serve upload commands on a Unix domain socket, one client at a time, until interrupted"""
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owning user may connect
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(sock_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    print(f"Listening on {sock_path}", file=sys.stderr)
+
+    try:
+        while True:
+            client, _ = server.accept()
+            with client, client.makefile("r", encoding="utf-8") as rfile, \
+                    client.makefile("w", encoding="utf-8") as wfile:
+                try:
+                    for line in rfile:
+                        if not line.strip():
+                            continue
+                        result = handle_command(uploader, line)
+                        wfile.write(json.dumps(result, ensure_ascii=False) + "\n")
+                        wfile.flush()
+                except OSError as e:
+                    print(f"Client error: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(sock_path)
+
+
+def build_parser():
+    """Build the full argparse parser, used for --help, errors and less common flags"""
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Upload images to Feishu/Lark",
         prog="feishu-upload-image"
@@ -175,8 +423,53 @@ def main():
         action="store_true",
         help="Only output the image_key"
     )
+    parser.add_argument(
+        "--daemon",
+        nargs="?",
+        const=default_socket_path(),
+        metavar="SOCKET",
+        help="Serve JSON upload commands on a Unix socket "
+             "(default: $XDG_RUNTIME_DIR/goclaw-feishu.sock)"
+    )
+    return parser
+
+
+# Flags handled by parse_args without argparse, mapped to their argparse dest
+_FAST_OPTIONS = {"-t": "type", "--type": "type", "--image-type": "image_type",
+                 "-u": "url", "--url": "url", "-o": "output", "--output": "output"}
+_FAST_SWITCHES = {"-b": "base64", "--base64": "base64", "-q": "quiet", "--quiet": "quiet"}
+_FAST_CHOICES = {"type": ("message", "avatar"), "image_type": ("message", "avatar"),
+                 "output": ("key", "json")}
+
+
+def parse_args(argv: list[str]) -> SimpleNamespace:
+    """Parse the common flags by hand, deferring to argparse for anything else"""
+    args = SimpleNamespace(input=None, type="message", image_type=None, url=None,
+                           base64=False, output="key", quiet=False, daemon=None)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in _FAST_SWITCHES:
+            setattr(args, _FAST_SWITCHES[arg], True)
+        elif arg in _FAST_OPTIONS and i + 1 < len(argv) and not argv[i + 1].startswith("-"):
+            dest = _FAST_OPTIONS[arg]
+            value = argv[i + 1]
+            if dest in _FAST_CHOICES and value not in _FAST_CHOICES[dest]:
+                return build_parser().parse_args(argv)
+            setattr(args, dest, value)
+            i += 1
+        elif not arg.startswith("-") and args.input is None:
+            args.input = arg
+        else:
+            # --help, --daemon, --opt=value, a flag given as an option value and
+            # other invalid input get argparse's handling
+            return build_parser().parse_args(argv)
+        i += 1
+    return args
 
-    args = parser.parse_args()
+
+def main():
+    args = parse_args(sys.argv[1:])
 
     # Resolve image_type
     image_type = args.image_type or args.type
@@ -187,6 +480,10 @@ def main():
     # Create uploader
     uploader = FeishuImageUploader(app_id, app_secret)
 
+    if args.daemon:
+        serve_socket(uploader, args.daemon)
+        return
+
     try:
         if args.url:
             # Upload from URL
@@ -205,7 +502,7 @@ def main():
                 # Upload from local file
                 image_key = uploader.upload_from_file(args.input, image_type)
         else:
-            parser.print_help()
+            build_parser().print_help()
             sys.exit(1)
 
         # Output result